@@ -6,6 +6,8 @@ Model Definition Module - Contains definitions and related functions for two-sta
 
 import torch
 from torch import nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 from transformers import T5ForConditionalGeneration
 
 
@@ -22,7 +24,7 @@ class TwoStageT5Model(nn.Module):
         self.correction_prompt = correction_prompt
        
         # Ensure tokenizer has [SENTSEP] token
-        if '[SENTSEP]' not in tokenizer.get_vocab():
+        if tokenizer.convert_tokens_to_ids('[SENTSEP]') == tokenizer.unk_token_id:
             special_tokens = {'additional_special_tokens': ['[SENTSEP]']}
             tokenizer.add_special_tokens(special_tokens)
            
@@ -31,6 +33,10 @@ class TwoStageT5Model(nn.Module):
                 self.model.resize_token_embeddings(len(tokenizer))
             if self.correction_model and hasattr(self.correction_model, 'resize_token_embeddings'):
                 self.correction_model.resize_token_embeddings(len(tokenizer))
+
+        # Pre-tokenize constant parts of the correction input
+        self._sentsep_ids = tokenizer.encode('[SENTSEP]', add_special_tokens=False)
+        self._prompt_ids = tokenizer.encode(correction_prompt, add_special_tokens=False) if correction_prompt else []
     
     def forward(self, input_ids, attention_mask=None, decoder_input_ids=None,
                 decoder_attention_mask=None, labels=None, correction_mode=False):
@@ -80,28 +86,26 @@ class TwoStageT5Model(nn.Module):
         # Get logits
         logits = outputs.logits
        
-        # Calculate loss for each sample and each position
-        loss_fct = torch.nn.CrossEntropyLoss(reduction='none')
-       
-        # Reshape
-        logits_flat = logits.view(-1, logits.size(-1))
-        labels_flat = labels.view(-1)
-       
-        # Calculate loss at each position
-        losses = loss_fct(logits_flat, labels_flat)
-        losses = losses.view(labels.size())
-       
-        # Create mask
-        mask = (labels != -100).float()
-       
+        # Calculate loss at each position (ignored positions yield 0)
+        losses = F.cross_entropy(
+            logits.view(-1, logits.size(-1)),
+            labels.view(-1),
+            ignore_index=-100,
+            reduction='none'
+        ).view(labels.size())
+
+        # Number of valid target positions per sample
+        valid = (labels != -100).sum(dim=1).clamp_min(1)
+
         # Calculate loss for each sample
-        sample_losses = (losses * mask).sum(dim=1) / mask.sum(dim=1)
+        sample_losses = losses.sum(dim=1) / valid
        
         # Apply weights
         weighted_loss = (sample_losses * sample_weights).mean()
        
         return weighted_loss
         
+    @torch.inference_mode()
     def generate_with_correction(self, input_ids, attention_mask=None, original_texts=None, **generate_kwargs):
         """
         Two-stage generation: first generate initial output with base model, then correct with correction model
@@ -126,37 +130,37 @@ class TwoStageT5Model(nn.Module):
             return initial_outputs
             
         # Decode initial output
-        decoded_outputs = [self.tokenizer.decode(ids, skip_special_tokens=True) 
-                          for ids in initial_outputs]
-        
+        decoded_outputs = self.tokenizer.batch_decode(initial_outputs, skip_special_tokens=True)
+
         # If original texts not provided, decode directly from input IDs
         if original_texts is None:
-            original_texts = [self.tokenizer.decode(ids, skip_special_tokens=True) 
-                             for ids in input_ids]
-        
-        # Create correction inputs
-        correction_inputs = []
-        for i, (orig_text, decoded_output) in enumerate(zip(original_texts, decoded_outputs)):
-            # Use prompt (if available)
-            if hasattr(self, 'correction_prompt') and self.correction_prompt:
-                correction_input = f"{orig_text} {self.correction_prompt} [SENTSEP] {decoded_output}"
-            else:
-                correction_input = f"{orig_text} [SENTSEP] {decoded_output}"
-            correction_inputs.append(correction_input)
-        
-        # Tokenize correction inputs
-        correction_input_ids = self.tokenizer.batch_encode_plus(
-            correction_inputs,
-            max_length=input_ids.size(1),
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt"
-        )["input_ids"].to(input_ids.device)
+            original_texts = self.tokenizer.batch_decode(input_ids, skip_special_tokens=True)
         
+        # Tokenize original texts and initial outputs separately
+        orig_ids = self.tokenizer(list(original_texts), add_special_tokens=False)["input_ids"]
+        output_ids = self.tokenizer(decoded_outputs, add_special_tokens=False)["input_ids"]
+
+        # Create correction inputs: [orig] [prompt] [SENTSEP] [output] </s>
+        max_length = input_ids.size(1)
+        eos_ids = [self.tokenizer.eos_token_id] if self.tokenizer.eos_token_id is not None else []
+        middle_ids = self._prompt_ids + self._sentsep_ids
+        correction_rows = []
+        for orig, output in zip(orig_ids, output_ids):
+            ids = (orig + middle_ids + output)[:max_length - len(eos_ids)] + eos_ids
+            correction_rows.append(torch.tensor(ids, dtype=torch.long))
+
+        # Pad correction inputs to the longest row in the batch
+        correction_input_ids = pad_sequence(
+            correction_rows, batch_first=True, padding_value=self.tokenizer.pad_token_id
+        ).to(input_ids.device)
+        correction_attention_mask = pad_sequence(
+            [torch.ones_like(row) for row in correction_rows], batch_first=True, padding_value=0
+        ).to(input_ids.device)
+
         # Stage 2: Correct initial output
         corrected_outputs = self.correction_model.generate(
             input_ids=correction_input_ids,
-            attention_mask=None,  # Use default attention mask
+            attention_mask=correction_attention_mask,
             **generate_kwargs
         )
         
@@ -177,8 +181,7 @@ def freeze_model_parameters(model, freeze_encoder=False, freeze_encoder_layers=0
     """
     # Freeze encoder (two methods: freeze all or freeze by layer)
     if freeze_encoder:
-        for param in model.encoder.parameters():
-            param.requires_grad = False
+        model.encoder.requires_grad_(False)
     elif freeze_encoder_layers > 0:
         encoder_blocks = model.encoder.block
         
@@ -191,9 +194,8 @@ def freeze_model_parameters(model, freeze_encoder=False, freeze_encoder_layers=0
         end_idx = freeze_encoder_layers
         
         # Freeze specified layers
-        for i in range(start_idx, end_idx):
-            for param in encoder_blocks[i].parameters():
-                param.requires_grad = False
+        for block in encoder_blocks[start_idx:end_idx]:
+            block.requires_grad_(False)
     
     # Freeze decoder layers
     if freeze_decoder_layers > 0:
@@ -213,11 +215,9 @@ def freeze_model_parameters(model, freeze_encoder=False, freeze_encoder_layers=0
             end_idx = n_layers
         
         # Freeze specified layers
-        for i in range(start_idx, end_idx):
-            for param in decoder_blocks[i].parameters():
-                param.requires_grad = False
+        for block in decoder_blocks[start_idx:end_idx]:
+            block.requires_grad_(False)
     
     # Freeze token embedding layer
     if freeze_embeddings:
-        for param in model.shared.parameters():
-            param.requires_grad = False
+        model.shared.requires_grad_(False)